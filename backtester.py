@@ -1,36 +1,81 @@
+import os
+import multiprocessing
 import polars as pl
 import numpy as np
 import matplotlib.pyplot as plt
-from multiprocessing import Pool
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
 import seaborn as sns
-from sklearn.linear_model import LinearRegression
-from numba import njit
+import optuna
+from kernels import compute_pnl, update_positions, warm_up
 
 
-@njit
-def update_positions(
-    position: np.ndarray,
-    long_entry: np.ndarray,
-    short_entry: np.ndarray,
-    long_exit: np.ndarray,
-    short_exit: np.ndarray,
+MS_PER_DAY: int = 86_400_000
+
+_SHARED_Z_SCORES: SharedMemory | None = None
+_Z_SCORES: np.ndarray = np.empty((0, 0))
+_Z_SCORE_ROW_BY_WINDOW: dict[int, int] = {}
+_TIMESTAMPS: np.ndarray = np.empty(0, dtype=np.int64)
+_PRICE: np.ndarray = np.empty(0)
+_TRANSACTION_COST: float = 0.0
+
+
+def _init_optimization_worker(
+    shm_name: str,
+    shape: tuple[int, int],
+    dtype: np.dtype,
+    rolling_windows: np.ndarray,
+    timestamps: np.ndarray,
+    price: np.ndarray,
+    transaction_cost: float,
 ) -> None:
-    for i in range(1, len(position)):
-        if position[i - 1] == 0:
-            if long_entry[i]:
-                position[i] = 1
-            elif short_entry[i]:
-                position[i] = -1
-        elif position[i - 1] == 1:
-            if long_exit[i]:
-                position[i] = 0
-            else:
-                position[i] = 1
-        elif position[i - 1] == -1:
-            if short_exit[i]:
-                position[i] = 0
-            else:
-                position[i] = -1
+    global _SHARED_Z_SCORES, _Z_SCORES, _Z_SCORE_ROW_BY_WINDOW
+    global _TIMESTAMPS, _PRICE, _TRANSACTION_COST
+    # Attach to the parent's z-score matrix; the view is zero-copy and read-only
+    _SHARED_Z_SCORES = SharedMemory(name=shm_name)
+    _Z_SCORES = np.ndarray(shape, dtype=dtype, buffer=_SHARED_Z_SCORES.buf)
+    _Z_SCORES.flags.writeable = False
+    _Z_SCORE_ROW_BY_WINDOW = {
+        int(window): i for i, window in enumerate(rolling_windows)
+    }
+    _TIMESTAMPS = timestamps
+    _PRICE = price
+    _TRANSACTION_COST = transaction_cost
+
+
+def _compute_sharpe_from_pnl(
+    timestamps: np.ndarray, pnl: np.ndarray, trading_days: int
+) -> float:
+    # Bucket millisecond timestamps by UTC day with integer division rather
+    # than converting to datetimes and grouping in Polars
+    _, day = np.unique(timestamps // MS_PER_DAY, return_inverse=True)
+    agg_pnl = np.bincount(day, weights=pnl)
+    if len(agg_pnl):
+        mean = np.mean(agg_pnl)
+        sd = np.std(agg_pnl, ddof=1)
+        if sd == 0:
+            return 0
+        return (mean / sd) * np.sqrt(trading_days)
+    return 0
+
+
+def _compute_sharpe_with_params(params: np.ndarray) -> tuple:
+    # Runs in the grid-search workers on the state set up by
+    # _init_optimization_worker, so each task only ships one (window, multiplier)
+    # row of the params grid
+    rolling_window, multiplier = int(params[0]), float(params[1])
+    z_score = _Z_SCORES[_Z_SCORE_ROW_BY_WINDOW[rolling_window]]
+    position = np.zeros(len(z_score))
+    update_positions(
+        position,
+        z_score > multiplier,
+        z_score < -1 * multiplier,
+        z_score <= 0,
+        z_score >= 0,
+    )
+    pnl = compute_pnl(position, _PRICE, _TRANSACTION_COST)
+    sharpe_ratio = _compute_sharpe_from_pnl(_TIMESTAMPS, pnl, 365)
+    return ((rolling_window, multiplier), sharpe_ratio)
 
 
 class BackTester:
@@ -41,81 +86,93 @@ class BackTester:
     def _print_factors(self) -> None:
         print(self.factors)
 
-    @staticmethod
-    @njit
-    def _update_positions(
-        position: np.ndarray,
-        long_entry: np.ndarray,
-        short_entry: np.ndarray,
-        long_exit: np.ndarray,
-        short_exit: np.ndarray,
-    ) -> None:
-        return update_positions(
-            position, long_entry, short_entry, long_exit, short_exit
+    _update_positions = staticmethod(update_positions)
+
+    def _with_z_score(
+        self, trade_info: pl.LazyFrame, rolling_window: int
+    ) -> pl.LazyFrame:
+        factor = pl.col("factor")
+        rolling_std = pl.col("rolling_std")
+        # The rolling kernels are materialised once as columns; used inline, the
+        # std appears in both the zero guard and the division and runs twice
+        return (
+            trade_info.with_columns(
+                factor.rolling_mean(window_size=rolling_window).alias("rolling_mean"),
+                factor.rolling_std(window_size=rolling_window).alias("rolling_std"),
+            )
+            .with_columns(
+                pl.when(rolling_std == 0)
+                .then(0.0)
+                .otherwise((factor - pl.col("rolling_mean")) / rolling_std)
+                .alias("z_score")
+            )
+            # Zero out the warm-up window so the signals need no null handling; a
+            # NaN factor leaves NaN z-scores, which give no signal
+            .with_columns(pl.col("z_score").fill_null(0.0))
         )
 
     def _z_score_strategy(self, rolling_window: int, multiplier: float) -> pl.DataFrame:
-        trade_info = pl.DataFrame()
-        rolling_mean = (
-            self.factors["factor"].rolling_mean(window_size=rolling_window).to_numpy()
-        )
-        rolling_std = (
-            self.factors["factor"].rolling_std(window_size=rolling_window).to_numpy()
+        trade_info = self._with_z_score(self.factors.lazy(), rolling_window)
+        z = pl.col("z_score")
+        # Polars orders NaN above every value, so a NaN z-score would pass the
+        # > and >= tests; as with NumPy comparisons it gives no signal instead
+        valid = z.is_not_nan()
+        signals = pl.struct(
+            ((z > multiplier) & valid).alias("long_entry"),
+            ((z < -1 * multiplier) & valid).alias("short_entry"),
+            ((z <= 0) & valid).alias("long_exit"),
+            ((z >= 0) & valid).alias("short_exit"),
         )
-        z_score = (self.factors["factor"].to_numpy() - rolling_mean) / rolling_std
-
-        z_score = np.where(rolling_std == 0, 0, z_score)
+        trade_info = trade_info.select(
+            pl.col("timestamp"),
+            signals.map_batches(
+                self._positions_from_signals, return_dtype=pl.Float64
+            ).alias("position"),
+        ).collect()
+        return trade_info
 
-        trade_info = trade_info.with_columns(
-            self.factors["timestamp"].alias("timestamp")
+    def _positions_from_signals(self, signals: pl.Series) -> pl.Series:
+        long_entry, short_entry, long_exit, short_exit = (
+            signals.struct.field(name).to_numpy()
+            for name in ("long_entry", "short_entry", "long_exit", "short_exit")
         )
-
-        long_entry = (z_score > multiplier).astype(int)
-        long_exit = (z_score <= 0).astype(int)
-        short_entry = (z_score < -1 * multiplier).astype(int) * -1
-        short_exit = (z_score >= 0).astype(int)
-
-        position: np.ndarray = np.zeros(len(self.factors["timestamp"]))
+        position: np.ndarray = np.zeros(len(signals))
         self._update_positions(position, long_entry, short_entry, long_exit, short_exit)
-        trade_info = trade_info.with_columns([pl.Series("position", position)])
-        return trade_info
+        return pl.Series("position", position)
 
-    def _compute_trans_cost(self, trade_info: pl.DataFrame) -> pl.DataFrame:
-        trade_info = trade_info.with_columns(
-            [
-                (
-                    abs(pl.col("position") - pl.col("position").shift(1))
-                    * self.TRANSACTION_COST
-                ).alias("trans_cost")
-            ]
+    def _pnl_from_positions(self, columns: pl.Series) -> pl.Series:
+        position, price = (
+            columns.struct.field(name).to_numpy() for name in ("position", "price")
         )
-        return trade_info
+        pnl = compute_pnl(position, price, self.TRANSACTION_COST)
+        # The first bar has no previous position, so its PnL stays null
+        return pl.Series("PnL", pnl).scatter(0, None)
 
-    def _compute_PnL(self, trade_info: pl.DataFrame) -> pl.DataFrame:
-        trade_info = self._compute_trans_cost(trade_info)
-        trade_info = trade_info.with_columns(
-            [
-                self.factors["price"].pct_change().alias("returns"),
-            ]
+    def _compute_all_pnl_columns(self, trade_info: pl.LazyFrame) -> pl.LazyFrame:
+        position = pl.col("position")
+        returns = pl.col("price").pct_change()
+        trans_cost = abs(position - position.shift(1)) * self.TRANSACTION_COST
+        # Same PnL kernel as the optimisers, so params are ranked on this PnL
+        pnl = pl.struct("position", "price").map_batches(
+            self._pnl_from_positions, return_dtype=pl.Float64
         )
-        trade_info = trade_info.with_columns(
-            [
-                (
-                    pl.col("position").shift(1) * pl.col("returns")
-                    - pl.col("trans_cost")
-                ).alias("PnL")
-            ]
-        )
-        return trade_info
-
-    def _compute_cum_PnL(self, trade_info: pl.DataFrame) -> pl.DataFrame:
-        trade_info = trade_info.with_columns(
-            [
-                pl.col("PnL").cum_sum().alias("strategy_cumPnL"),
-                pl.col("returns").cum_sum().alias("benchmark_cumPnL"),
-            ]
+        return (
+            trade_info.with_columns(self.factors["price"])
+            .with_columns(
+                [
+                    trans_cost.alias("trans_cost"),
+                    returns.alias("returns"),
+                    pnl.alias("PnL"),
+                ]
+            )
+            .with_columns(
+                [
+                    pl.col("PnL").cum_sum().alias("strategy_cumPnL"),
+                    pl.col("returns").cum_sum().alias("benchmark_cumPnL"),
+                ]
+            )
+            .drop("price")
         )
-        return trade_info
 
     def _compute_trade_statistics(
         self, rolling_window: int, multiplier: float
@@ -123,9 +180,7 @@ class BackTester:
         if self.factors is None:
             raise ValueError("Factors DataFrame is not provided")
         trade_info: pl.DataFrame = self._z_score_strategy(rolling_window, multiplier)
-        trade_info = self._compute_PnL(trade_info)
-        trade_info = self._compute_cum_PnL(trade_info)
-        return trade_info
+        return self._compute_all_pnl_columns(trade_info.lazy()).collect()
 
     def _convert_humanized_timestamp(self, df: pl.dataframe) -> pl.dataframe:
         df = df.with_columns(
@@ -133,23 +188,24 @@ class BackTester:
         )
         return df
 
+    def _compute_pnl_series(
+        self, rolling_window: int, multiplier: float
+    ) -> tuple[np.ndarray, np.ndarray]:
+        trade_info = self._z_score_strategy(rolling_window, multiplier)
+        timestamps = trade_info["timestamp"].to_numpy()
+        position = trade_info["position"].to_numpy()
+        price = self.factors["price"].to_numpy()
+        pnl = compute_pnl(position, price, self.TRANSACTION_COST)
+        return timestamps, pnl
+
     def compute_sharpe_ratio(
         self, trade_info: pl.DataFrame, trading_days: int
     ) -> float:
-        trade_info = self._convert_humanized_timestamp(trade_info)
-        trade_info = (
-            trade_info.with_columns(pl.col("humanized_timestamp").dt.truncate("1d"))
-            .group_by("humanized_timestamp")
-            .agg(pl.col("PnL").sum().alias("aggPnL"))
+        return _compute_sharpe_from_pnl(
+            trade_info["timestamp"].to_numpy(),
+            trade_info["PnL"].fill_null(0).to_numpy(),
+            trading_days,
         )
-        agg_pnl = trade_info["aggPnL"].drop_nulls().to_list()
-        if agg_pnl:
-            mean = np.mean(agg_pnl)
-            sd = np.std(agg_pnl, ddof=1)
-            if sd == 0:
-                return 0
-            return (mean / sd) * np.sqrt(trading_days)
-        return 0
 
     def compute_information_ratio(
         self, trade_info: pl.DataFrame, trading_days: int
@@ -179,22 +235,24 @@ class BackTester:
 
     def _compute_beta(self, trade_info: pl.DataFrame):
         strategy = trade_info["PnL"].drop_nulls().to_numpy()
-        benchmark = trade_info["returns"].drop_nulls().to_numpy().reshape(-1, 1)
-        model = LinearRegression()
-        model.fit(benchmark, strategy)
-        slope = model.coef_[0]
-        return slope
+        benchmark = trade_info["returns"].drop_nulls().to_numpy()
+        # OLS slope of strategy on benchmark: cov(benchmark, strategy) / var(benchmark)
+        benchmark = benchmark - benchmark.mean()
+        slope = benchmark @ (strategy - strategy.mean()) / (benchmark @ benchmark)
+        return float(slope)
 
     def _compute_max_drawdown(self, trade_info: pl.DataFrame):
-        returns = trade_info.select("PnL").drop_nulls().to_numpy()
-        cum_prod_returns = np.cumprod(1 + returns)
-        running_max = np.maximum.accumulate(cum_prod_returns)
-        drawdown = cum_prod_returns / running_max - 1
-        return np.min(drawdown)
+        cum_pnl = trade_info["strategy_cumPnL"].drop_nulls().to_numpy()
+        running_max = np.maximum.accumulate(cum_pnl)
+        drawdown = cum_pnl - running_max
+        return float(np.min(drawdown))
 
     def _compute_long_short_ratio(self, trade_info: pl.DataFrame) -> float | None:
-        long_count = trade_info.filter(pl.col("position") == 1).shape[0]
-        short_count = trade_info.filter(pl.col("position") == -1).shape[0]
+        position = trade_info["position"].to_numpy()
+        # Positions are -1, 0 or 1, so shifting by one gives bins short/flat/long
+        short_count, _, long_count = np.bincount(
+            position.astype(np.int64) + 1, minlength=3
+        )
         if (short_count != 0) and (long_count != 0):
             return long_count / short_count
         return None
@@ -220,20 +278,80 @@ class BackTester:
         )
 
     def _compute_sharpe_in_optimization(self, params: tuple[int, float]) -> float:
-        trade_stat = self._compute_trade_statistics(params[0], params[1])
-        return self.compute_sharpe_ratio(trade_stat, 365)
+        timestamps, pnl = self._compute_pnl_series(params[0], params[1])
+        return _compute_sharpe_from_pnl(timestamps, pnl, 365)
 
-    def _compute_sharpe_with_params(self, params: tuple[int, float]) -> tuple:
-        sharpe_ratio = self._compute_sharpe_in_optimization(params)
-        return (params, sharpe_ratio)
+    def search_params(
+        self,
+        rolling_window_range: tuple[int, int],
+        multiplier_range: tuple[float, float],
+        n_trials: int = 100,
+        rolling_window_step: int = 10,
+    ) -> tuple[tuple[int, float], float]:
+        # Sharpe is smooth over the params set, so a TPE search reaches the best
+        # region in far fewer backtests than an exhaustive grid
+        def objective(trial: optuna.Trial) -> float:
+            params = (
+                trial.suggest_int(
+                    "rolling_window", *rolling_window_range, step=rolling_window_step
+                ),
+                trial.suggest_float("multiplier", *multiplier_range),
+            )
+            return self._compute_sharpe_in_optimization(params)
+
+        study = optuna.create_study(direction="maximize")
+        study.optimize(objective, n_trials=n_trials)
+        best_params = (
+            study.best_params["rolling_window"],
+            study.best_params["multiplier"],
+        )
+        return best_params, study.best_value
 
     def optimize_params_and_plot_heatmap(
         self, rolling_windows: np.ndarray, multipliers: np.ndarray
     ) -> None:
         # Creating all combinations of rolling_windows and multipliers
-        xy_pairs = [(xi, yi) for yi in multipliers for xi in rolling_windows]
-        with Pool() as pool:
-            results = pool.map(self._compute_sharpe_with_params, xy_pairs)
+        windows_grid, multipliers_grid = np.meshgrid(rolling_windows, multipliers)
+        xy_pairs = np.column_stack([windows_grid.ravel(), multipliers_grid.ravel()])
+        # z-score depends only on window; compute each row once into shared memory
+        z_score_frames = pl.collect_all(
+            [
+                self._with_z_score(self.factors.lazy(), int(window)).select("z_score")
+                for window in rolling_windows
+            ]
+        )
+        shape = (len(rolling_windows), len(self.factors))
+        dtype = np.dtype(np.float32)
+        shm = SharedMemory(create=True, size=shape[0] * shape[1] * dtype.itemsize)
+        shared_z_scores = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        chunksize = max(1, len(xy_pairs) // (4 * (os.cpu_count() or 1)))
+        try:
+            for row, frame in enumerate(z_score_frames):
+                shared_z_scores[row] = frame["z_score"].to_numpy()
+            # Spawn rather than fork the workers: Polars' thread pool is already
+            # running, and forking after that can deadlock
+            with ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_optimization_worker,
+                initargs=(
+                    shm.name,
+                    shape,
+                    dtype,
+                    rolling_windows,
+                    self.factors["timestamp"].to_numpy(),
+                    self.factors["price"].to_numpy(),
+                    self.TRANSACTION_COST,
+                ),
+            ) as executor:
+                results = list(
+                    executor.map(
+                        _compute_sharpe_with_params, xy_pairs, chunksize=chunksize
+                    )
+                )
+        finally:
+            del shared_z_scores
+            shm.close()
+            shm.unlink()
         xy_pairs, z_values = zip(*results)
         z = np.array(z_values).reshape(len(multipliers), len(rolling_windows))
         rolling_windows_expanded = np.append(
@@ -292,11 +410,12 @@ if __name__ == "__main__":
     trade_info = backtester._compute_trade_statistics(525, 1.7)
     backtester.print_trade_summary_stats(525, 1.7)
     backtester.plot_returns(trade_info)
-    rolling_windows = np.array(
-        [i for i in range(10, 101, 10)]
-        + [i for i in range(100, 501, 20)]
-        + [i for i in range(500, 1001, 25)]
-    )
-    rolling_windows = np.array(rolling_windows)
-    multipliers = np.arange(0.2, 4.2, 0.2)
+    # Compile the kernels the workers call before the pool starts, so that the
+    # spawned workers load them from numba's on-disk cache
+    warm_up()
+    best_params, best_sharpe = backtester.search_params((10, 1000), (0.0, 4.0))
+    print(f"Best Params Set {best_params} with Sharpe Ratio {best_sharpe:.3f}")
+    # A coarse grid is enough to show the shape of the Sharpe surface
+    rolling_windows = np.arange(100, 1001, 100)
+    multipliers = np.arange(0.4, 4.1, 0.4)
     backtester.optimize_params_and_plot_heatmap(rolling_windows, multipliers)
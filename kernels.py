@@ -0,0 +1,93 @@
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def update_positions(
+    position: np.ndarray,
+    long_entry: np.ndarray,
+    short_entry: np.ndarray,
+    long_exit: np.ndarray,
+    short_exit: np.ndarray,
+) -> None:
+    for i in range(1, len(position)):
+        if position[i - 1] == 0:
+            if long_entry[i]:
+                position[i] = 1
+            elif short_entry[i]:
+                position[i] = -1
+        elif position[i - 1] == 1:
+            if long_exit[i]:
+                position[i] = 0
+            else:
+                position[i] = 1
+        elif position[i - 1] == -1:
+            if short_exit[i]:
+                position[i] = 0
+            else:
+                position[i] = -1
+
+
+@njit(cache=True)
+def rolling_mean_std(array: np.ndarray, window_size: int) -> tuple:
+    n = array.shape[0]
+    rolling_mean = np.full(n, np.nan)
+    rolling_std = np.full(n, np.nan)
+    if window_size < 2 or window_size > n:
+        return rolling_mean, rolling_std
+
+    mean = 0.0
+    m2 = 0.0
+    # Length of the run of equal values ending at i
+    run = 1
+    for i in range(1, window_size - 1):
+        run = run + 1 if array[i] == array[i - 1] else 1
+    for i in range(window_size - 1, n):
+        run = run + 1 if array[i] == array[i - 1] else 1
+        if run >= window_size:
+            # A constant window has exactly zero variance; the sliding update
+            # would leave rounding residue instead
+            mean = array[i]
+            m2 = 0.0
+        elif (i + 1) % window_size == 0 or np.isnan(m2):
+            # Restart from the raw window every window_size steps so the
+            # rounding error of the sliding update cannot accumulate, and
+            # while a NaN is in the window so it does not poison later ones.
+            mean = 0.0
+            m2 = 0.0
+            for k in range(window_size):
+                x = array[i - window_size + 1 + k]
+                delta = x - mean
+                mean += delta / (k + 1)
+                m2 += delta * (x - mean)
+        else:
+            # Welford add/remove update: slide the window by one sample
+            new = array[i]
+            old = array[i - window_size]
+            prev_mean = mean
+            mean += (new - old) / window_size
+            m2 += (new - old) * (new - mean + old - prev_mean)
+        rolling_mean[i] = mean
+        rolling_std[i] = np.sqrt(max(m2, 0.0) / (window_size - 1))
+    return rolling_mean, rolling_std
+
+
+@njit(cache=True)
+def compute_pnl(
+    position: np.ndarray, price: np.ndarray, transaction_cost: float
+) -> np.ndarray:
+    # PnL of holding the previous bar's position, net of the cost of changing it;
+    # the first bar has no previous position and earns nothing
+    pnl = np.zeros(len(position))
+    for i in range(1, len(position)):
+        pnl[i] = position[i - 1] * (price[i] / price[i - 1] - 1) - (
+            abs(position[i] - position[i - 1]) * transaction_cost
+        )
+    return pnl
+
+
+def warm_up() -> None:
+    position = np.zeros(4)
+    signal = np.zeros(4, dtype=np.bool_)
+    update_positions(position, signal, signal, signal, signal)
+    compute_pnl(position, np.ones(4), 0.0)
@@ -1,6 +1,12 @@
 import numpy as np
 import polars as pl
 import pandas as pd
+from kernels import rolling_mean_std
+
+
+def _last_index(mask: np.ndarray) -> np.ndarray:
+    # Index of the most recent True at or before each bar, -1 if there is none
+    return np.maximum.accumulate(np.where(mask, np.arange(len(mask)), -1))
 
 
 class VectorBackTester:
@@ -9,49 +15,32 @@ class VectorBackTester:
         self.TRANSACTION_COST: float = 0.06 / 100
         self.factor: np.ndarray = self.factors["factor"].to_numpy()
 
-    def _compute_rolling_mean(self, array: np.ndarray, window_size: int) -> np.ndarray:
-        rolling_array = np.array([np.nan] * len(array))
-        window = np.ones(window_size) / window_size
-        rolling_mean = np.convolve(array, window, mode="valid")
-        rolling_array[window_size - 1 :] = rolling_mean
-        return rolling_array
-
-    def _compute_rolling_std(self, array: np.ndarray, window_size: int) -> np.ndarray:
-        return np.array(
-            [np.nan] * (window_size - 1)
-            + [
-                np.std(array[i : i + window_size], ddof=1)
-                for i in range(len(array) - window_size + 1)
-            ]
-        )
-
     def _z_score_strategy_position(
         self, rolling_window: int, threshold: float
     ) -> np.ndarray:
-        rolling_mean = self._compute_rolling_mean(self.factor, rolling_window)
-        rolling_std = self._compute_rolling_std(self.factor, rolling_window)
-        z_score = (self.factor - rolling_mean) / rolling_std
-
-        long_entry = (z_score > threshold).astype(int)
-        long_exit = (z_score <= 0).astype(int)
-
-        short_entry = (z_score < -1 * threshold).astype(int) * -1
-        short_exit = (z_score >= 0).astype(int)
-
-        position: np.ndarray = np.zeros(len(self.factor))
-        for i in range(1, len(position)):
-            if long_entry[i]:
-                position[i] = 1
-            elif short_entry[i]:
-                position[i] = -1
-            else:
-                position[i] = position[i - 1]
-
-            if (position[i] == 1 and long_exit[i]) or (
-                position[i] == -1 and short_exit[i]
-            ):
-                position[i] = 0
-        return position
+        rolling_mean, rolling_std = rolling_mean_std(self.factor, rolling_window)
+        # A zero rolling std gives a z-score of 0, as in BackTester._with_z_score
+        z_score = np.divide(
+            self.factor - rolling_mean,
+            rolling_std,
+            out=np.zeros(len(self.factor)),
+            where=rolling_std != 0,
+        )
+
+        long_entry = z_score > threshold
+        long_exit = z_score <= 0
+
+        short_entry = z_score < -1 * threshold
+        short_exit = z_score >= 0
+
+        # No trade is opened on the first bar
+        long_entry[0] = short_entry[0] = False
+
+        # A side is open while its latest entry is more recent than its latest
+        # exit, so the position follows from running maxima of event indices
+        long_open = _last_index(long_entry) > _last_index(long_exit)
+        short_open = _last_index(short_entry) > _last_index(short_exit)
+        return long_open.astype(np.float64) - short_open
 
 
 if __name__ == "__main__":